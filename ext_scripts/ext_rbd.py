@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 # Copyright (C) 2016-2017 GRNET S.A.
 #
@@ -44,118 +44,359 @@ The following variables are optional:
  - EXTP_STRIPE_COUNT Number of consecutive objects in a stripe
  - EXTP_USERSPACE_ONLY Set if only userspace access is requested
  - EXTP_USP_* Parameters to append to the userspace URI
+ - EXTP_DEBUG Set to log a traceback for unexpected errors
 
 The code branches to the correct function, depending on the name (sys.argv[0])
 of the executed script (attach, create, etc).
 
+Images are created, resized and removed through the librados/librbd Python
+bindings, if they are installed, which saves forking an rbd process for each
+operation. Otherwise, and for mapping images to block devices, the rbd command
+line tool is used. Existing mappings are read from, and removed through, sysfs.
+
 Returns O after successful completion, 1 on failure
 
 """
 
 import os
 import sys
-import subprocess
 import json
-import re
+import errno
+import time
+import atexit
+import shutil
+import socket
+import threading
+import traceback
+import subprocess
+from contextlib import contextmanager
 
-TRUE_PATTERN = '^(yes|true|on|1|set)$'
+# The rados and rbd bindings, imported on first use by have_bindings()
+rados = rbd = None
+_have_bindings = None
+
+TRUE_VALUES = frozenset(('yes', 'true', 'on', '1', 'set'))
 PREFIX_EXTP = 'EXTP_'
 PREFIX_USP = 'usp_'
+# cephx settings, named after the rbd options that pass them
+CEPHX_KEYS = ('id', 'keyring', 'keyfile')
+CEPH_CONF = '/etc/ceph/ceph.conf'
+# Seconds librados may wait for the monitors (connecting, mon commands) and
+# the OSDs (each I/O), so an unreachable cluster fails the hook instead of
+# hanging it
+CONNECT_TIMEOUT = 30
+OP_TIMEOUT = 60
+DEFAULT_POOL = 'rbd'
+# Binary multipliers of the size suffixes rbd accepts, e.g. --stripe-unit 64K
+SIZE_SUFFIXES = {'B': 1, 'K': 1 << 10, 'M': 1 << 20,
+                 'G': 1 << 30, 'T': 1 << 40}
+SYSFS_BUS = '/sys/bus'
+SYSFS_RBD_DEVICES = '/sys/bus/rbd/devices'
+# remove_single_major is only there if the module uses a single major number,
+# in which case remove refuses to work
+SYSFS_RBD_REMOVE = ('/sys/bus/rbd/remove_single_major', '/sys/bus/rbd/remove')
+# How long to wait for udev to remove the device node of an unmapped image
+UNMAP_TIMEOUT = 10
+DAEMON_SOCKET = '/run/gnt-extstorage-rbd.sock'
+# How long to wait to connect to the daemon before running the action
+# ourselves. Once it has the request, we wait for its reply, as the action
+# must not run twice.
+DAEMON_TIMEOUT = 60
+RBD_FEATURES = {
+    'layering': 'RBD_FEATURE_LAYERING',
+    'striping': 'RBD_FEATURE_STRIPINGV2',
+    'exclusive-lock': 'RBD_FEATURE_EXCLUSIVE_LOCK',
+    'object-map': 'RBD_FEATURE_OBJECT_MAP',
+    'fast-diff': 'RBD_FEATURE_FAST_DIFF',
+    'deep-flatten': 'RBD_FEATURE_DEEP_FLATTEN',
+    'journaling': 'RBD_FEATURE_JOURNALING',
+}
+
+# The action to run is the name of the script (attach, create, etc.)
+_ACTION = os.path.basename(sys.argv[0])
+
+# Cluster handles, by cephx credentials, and their per-pool I/O contexts,
+# shared by all librbd calls of this process. They are set up lazily, on the
+# first call that needs them. The daemon calls get_ioctx() from several
+# threads, so _lock guards both.
+_clusters = {}
+_ioctx = {}
+_lock = threading.Lock()
 
 
-def cmd_open(cmd, bufsize=-1, env=None):
-    inst = subprocess.Popen(cmd, shell=False, bufsize=bufsize,
-                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE, close_fds=True)
-    return inst
+class RBDException(Exception):
+    pass
 
 
-def doexec(args, inputtext=None):
-    proc = cmd_open(args)
-    if inputtext is not None:
-        proc.stdin.write(inputtext)
-    stdout = proc.stdout
-    stderr = proc.stderr
-    rc = proc.wait()
-    return (rc, stdout, stderr)
+def have_bindings():
+    """Import the rados and rbd bindings, if they are installed"""
+    global rados, rbd, _have_bindings
+    if _have_bindings is None:
+        try:
+            import rados
+            import rbd
+            _have_bindings = True
+        except ImportError:
+            rados = rbd = None
+            _have_bindings = False
+    return _have_bindings
+
+
+def get_ioctx(pool=None, cephx=None):
+    """Return a (cached) librados I/O context for the given pool"""
+    cephx = cephx or {}
+    creds = tuple(cephx.get(k) for k in CEPHX_KEYS)
+    # Connect and open the pool outside _lock, so that a slow cluster for
+    # one set of credentials does not block the other daemon threads. If
+    # another thread gets there first, keep its handle and drop ours.
+    with _lock:
+        cluster = _clusters.get(creds)
+    if cluster is None:
+        # Rados.connect() ignores its timeout argument, so set it here
+        conf = {'client_mount_timeout': str(CONNECT_TIMEOUT),
+                'rados_mon_op_timeout': str(CONNECT_TIMEOUT),
+                'rados_osd_op_timeout': str(OP_TIMEOUT)}
+        for k in ('keyring', 'keyfile'):
+            if cephx.get(k) is not None:
+                conf[k] = str(cephx[k])
+        new = rados.Rados(conffile=CEPH_CONF,
+                          rados_id=cephx.get('id'), conf=conf)
+        try:
+            new.connect()
+        except Exception:
+            new.shutdown()
+            raise
+        with _lock:
+            cluster = _clusters.setdefault(creds, new)
+        if cluster is not new:
+            new.shutdown()
+
+    pool = pool or default_pool(cluster)
+    with _lock:
+        ioctx = _ioctx.get((creds, pool))
+    if ioctx is None:
+        new = cluster.open_ioctx(pool)
+        with _lock:
+            ioctx = _ioctx.setdefault((creds, pool), new)
+        if ioctx is not new:
+            new.close()
+    return ioctx
+
+
+def default_pool(cluster):
+    """Return the pool rbd uses when none is given (rbd_default_pool)"""
+    try:
+        return cluster.conf_get('rbd_default_pool') or DEFAULT_POOL
+    except rados.Error:
+        return DEFAULT_POOL
 
 
-class RBDException(Exception):
-    pass
+def shutdown():
+    """Close the cached I/O contexts and cluster connections"""
+    # The daemon only exits once its requests are done, so no other thread
+    # is using them by now
+    with _lock:
+        for ioctx in _ioctx.values():
+            ioctx.close()
+        _ioctx.clear()
+        for cluster in _clusters.values():
+            cluster.shutdown()
+        _clusters.clear()
+
+
+atexit.register(shutdown)
+
+
+@contextmanager
+def librbd_op(op, image):
+    """Translate librados/librbd errors to RBDException"""
+    try:
+        yield
+    except (rados.Error, rbd.Error) as e:
+        raise RBDException('%s %s failed (%s)' % (op, image, e))
 
 
 class RBD(object):
-    RBD_CMD = 'rbd'
+    # subprocess only spawns commands given by path with posix_spawn()
+    RBD_CMD = shutil.which('rbd') or 'rbd'
+    # The kernel's mappings and (pool, image) -> device and image -> device
+    # indexes of them, cached per thread until we (un)map an image
+    _cache = threading.local()
 
     @staticmethod
     def format_name(name, pool=None, snapshot=None):
-        image_name = name
         if pool is not None:
-            image_name = pool + '/' + image_name
+            name = f'{pool}/{name}'
         if snapshot is not None:
-            image_name = image_name + '@' + snapshot
-        return image_name
+            name = f'{name}@{snapshot}'
+        return name
 
     @staticmethod
-    def _exc(args):
-        rc, stdout, stderr = doexec([RBD.RBD_CMD] + args)
-        out, err = stdout.read().strip(), stderr.read().strip()
-        stdout.close()
-        stderr.close()
-        if rc:
+    def _exc(args, capture=True):
+        stdout = subprocess.PIPE if capture else subprocess.DEVNULL
+        # File descriptors are not inherited by default (PEP 446), so there
+        # is no need to close them in the child. Not asking for it lets
+        # subprocess use posix_spawn() instead of fork() + exec().
+        res = subprocess.run([RBD.RBD_CMD] + args, stdout=stdout,
+                             stderr=subprocess.PIPE, close_fds=False)
+        out = (res.stdout or b'').decode('utf-8', 'replace').strip()
+        err = res.stderr.decode('utf-8', 'replace').strip()
+        if res.returncode:
             raise RBDException('%s failed (%s %s %s)' %
-                               (args, rc, out, err))
+                               (args, res.returncode, out, err))
         return out
 
     @staticmethod
-    def exc(cephx, *args):
-        args = list(args)
+    def exc(cephx, argv, capture=True, log=None):
         if cephx:
             cephx_args = []
-            if cephx.get('id') is not None:
-                id = str(cephx.get('id'))
-                cephx_args.append('--id')
-                cephx_args.append(id)
-                sys.stderr.write("Using cephx id %s\n" % id)
-            if cephx.get('keyring') is not None:
-                keyring = str(cephx.get('keyring'))
-                cephx_args.append('--keyring')
-                cephx_args.append(keyring)
-                sys.stderr.write("Using cephx keyring %s\n" % keyring)
-            if cephx.get('keyfile') is not None:
-                keyfile = str(cephx.get('keyfile'))
-                cephx_args.append('--keyfile')
-                cephx_args.append(keyfile)
-                sys.stderr.write("Using cephx keyfile %s\n" % keyfile)
-
-            args = cephx_args + args
-
-        return RBD._exc(args)
+            msgs = []
+            for key in CEPHX_KEYS:
+                value = cephx.get(key)
+                if value is not None:
+                    cephx_args += ['--' + key, str(value)]
+                    msgs.append("Using cephx %s %s\n" % (key, value))
+            (log or sys.stderr).write("".join(msgs))
+
+            argv = cephx_args + argv
+
+        return RBD._exc(argv, capture=capture)
 
     @staticmethod
-    def list(pool=None, cephx=None):
-        mappings = json.loads(RBD.exc(cephx, 'showmapped', '--format', 'json'))
+    def run(cephx, argv, log=None):
+        """ Like exc(), for commands whose output we do not need """
+        RBD.exc(cephx, argv, capture=False, log=log)
+
+    @staticmethod
+    def invalidate_mappings():
+        """ Forget the cached mappings, so the next list() re-reads them """
+        RBD._cache.mappings = RBD._cache.devices = RBD._cache.names = None
+
+    @staticmethod
+    def _list_sysfs():
+        """ Read the kernel's RBD mappings from sysfs """
+        mappings = {}
+        for entry in os.scandir(SYSFS_RBD_DEVICES):
+            mapping = {'device': '/dev/rbd' + entry.name}
+            try:
+                for key, attr in (('pool', 'pool'), ('name', 'name'),
+                                  ('snap', 'current_snap')):
+                    with open(os.path.join(entry.path, attr)) as f:
+                        mapping[key] = f.read().strip()
+            except OSError as e:
+                # Unmapped while we were reading it
+                if e.errno in (errno.ENOENT, errno.ENODEV):
+                    continue
+                raise
+            mappings[entry.name] = mapping
+        return mappings
+
+    @staticmethod
+    def _list_showmapped(cephx=None, log=None):
+        """ Read the kernel's RBD mappings with 'rbd showmapped' """
+        mappings = {}
+        # The plain output is a table of 'id pool image snap device'.
+        # Newer rbd versions add a namespace column, which may be empty,
+        # after the pool, so take the image and on from the end.
+        for line in RBD.exc(cephx, ['showmapped'], log=log).splitlines()[1:]:
+            fields = line.split()
+            if len(fields) < 5:
+                continue
+            mappings[fields[0]] = {'pool': fields[1],
+                                   'name': fields[-3],
+                                   'snap': fields[-2],
+                                   'device': fields[-1]}
+        return mappings
+
+    @staticmethod
+    def _load_mappings(cephx=None, log=None):
+        cache = RBD._cache
+        if getattr(cache, 'mappings', None) is None:
+            try:
+                mappings = RBD._list_sysfs()
+            except FileNotFoundError:
+                if os.path.isdir(SYSFS_BUS):
+                    # sysfs is there but the rbd module is not loaded, so
+                    # nothing can be mapped
+                    mappings = {}
+                else:
+                    mappings = RBD._list_showmapped(cephx=cephx, log=log)
+            cache.devices = {}
+            cache.names = {}
+            for v in mappings.values():
+                cache.devices[(v['pool'], v['name'])] = v['device']
+                # Without a pool, the first image with that name matches
+                cache.names.setdefault(v['name'], v['device'])
+            cache.mappings = mappings
+        return cache.mappings
+
+    @staticmethod
+    def list(pool=None, cephx=None, log=None):
+        mappings = RBD._load_mappings(cephx=cephx, log=log)
         if pool:
-            return {k: v for k, v in mappings.iteritems() if v['pool'] == pool}
+            return {k: v for k, v in mappings.items() if v['pool'] == pool}
         else:
             return mappings
 
     @staticmethod
-    def get_device(image, pool=None, cephx=None):
+    def get_device(image, pool=None, cephx=None, log=None):
         """ Return the device the image is mapped else None"""
-        list = RBD.list(pool=pool, cephx=cephx)
-        for mapping in list.itervalues():
-            if mapping['name'] == image:
-                return mapping['device']
+        RBD._load_mappings(cephx=cephx, log=log)
+        if pool is not None:
+            return RBD._cache.devices.get((pool, image))
+        return RBD._cache.names.get(image)
 
-        return None
+    @staticmethod
+    def to_int(param, value, suffixes=False):
+        """ Convert a parameter to an int, optionally with a size suffix """
+        number = str(value).strip()
+        multiplier = 1
+        if suffixes and number[-1:].upper() in SIZE_SUFFIXES:
+            multiplier = SIZE_SUFFIXES[number[-1].upper()]
+            number = number[:-1]
+        try:
+            return int(number) * multiplier
+        except ValueError:
+            raise RBDException("Invalid %s '%s'" % (param, value))
 
     @staticmethod
-    def create(image, size, pool=None, image_format=None, image_feature=None,
-               stripe_unit=None, stripe_count=None, cephx=None):
-        """ Map an image to an RBD device """
+    def features(image_feature):
+        """ Convert an --image-feature value to a librbd feature mask """
+        features = 0
+        for feature in str(image_feature).split(','):
+            feature = feature.strip()
+            if feature.isdigit():
+                features |= int(feature)
+            elif hasattr(rbd, RBD_FEATURES.get(feature, '')):
+                features |= getattr(rbd, RBD_FEATURES[feature])
+            else:
+                raise RBDException("Unsupported image feature '%s'" % feature)
+        return features
 
-        image = RBD.format_name(image, pool=pool)
+    @staticmethod
+    def create(image, size, pool=None, image_format=None, image_feature=None,
+               stripe_unit=None, stripe_count=None, cephx=None, log=None):
+        """ Create a new RBD image """
+        full_name = RBD.format_name(image, pool=pool)
+
+        if have_bindings():
+            with librbd_op('create', full_name):
+                if image_format not in (None, '1', '2'):
+                    raise RBDException("Invalid image_format '%s'"
+                                       % image_format)
+                size = RBD.to_int('size', size) * 1024 * 1024
+                kwargs = {'old_format': image_format == '1'}
+                if image_feature is not None:
+                    kwargs['features'] = RBD.features(image_feature)
+                if stripe_unit is not None:
+                    kwargs['stripe_unit'] = RBD.to_int(
+                        'stripe_unit', stripe_unit, suffixes=True)
+                if stripe_count is not None:
+                    kwargs['stripe_count'] = RBD.to_int(
+                        'stripe_count', stripe_count)
+                ioctx = get_ioctx(pool, cephx=cephx)
+                rbd.RBD().create(ioctx, image, size, **kwargs)
+            return
 
         args = []
         if image_format is not None:
@@ -171,78 +412,122 @@ class RBD(object):
             args.append('--stripe-count')
             args.append(str(stripe_count))
 
-        return RBD.exc(cephx, 'create', image, '--size', str(size), *args)
+        RBD.run(cephx, ['create', full_name, '--size', str(size)] + args,
+                log=log)
 
     @staticmethod
-    def map(image, pool=None, cephx=None):
+    def map(image, pool=None, cephx=None, log=None):
         """ Map an image to an RBD device """
         image = RBD.format_name(image, pool=pool)
-        return RBD.exc(cephx, 'map', image)
+        RBD.invalidate_mappings()
+        return RBD.exc(cephx, ['map', image], log=log)
 
     @staticmethod
-    def unmap(device, cephx=None):
+    def unmap(device, cephx=None, log=None):
         """ Unmap an RBD device """
-        return RBD.exc(cephx, 'unmap', device)
+        RBD.invalidate_mappings()
+        dev_id = device[len('/dev/rbd'):]
+        if device.startswith('/dev/rbd') and dev_id.isdigit():
+            # Ask the kernel directly, like 'rbd unmap' does
+            for path in SYSFS_RBD_REMOVE:
+                try:
+                    fd = os.open(path, os.O_WRONLY)
+                    try:
+                        os.write(fd, dev_id.encode('ascii'))
+                    finally:
+                        os.close(fd)
+                except FileNotFoundError:
+                    continue
+                except PermissionError:
+                    break
+                except OSError as e:
+                    raise RBDException('unmap %s failed (%s)' % (device, e))
+                # Like 'rbd unmap', wait for udev to remove the device node,
+                # so that Ganeti does not find a stale /dev/rbdN afterwards
+                deadline = time.monotonic() + UNMAP_TIMEOUT
+                while os.path.exists(device):
+                    if time.monotonic() > deadline:
+                        (log or sys.stderr).write(
+                            "Warning: %s still exists after %s seconds\n"
+                            % (device, UNMAP_TIMEOUT))
+                        break
+                    time.sleep(0.1)
+                return
+
+        RBD.run(cephx, ['unmap', device], log=log)
 
     @staticmethod
-    def resize(image, size, pool=None, cephx=None):
-        """ Unmap an RBD device """
-        image = RBD.format_name(image, pool=pool)
-        return RBD.exc(cephx, 'resize', image, '--size', size)
+    def resize(image, size, pool=None, cephx=None, log=None):
+        """ Grow an RBD image """
+        full_name = RBD.format_name(image, pool=pool)
+        if have_bindings():
+            with librbd_op('resize', full_name):
+                size = RBD.to_int('size', size) * 1024 * 1024
+                ioctx = get_ioctx(pool, cephx=cephx)
+                with rbd.Image(ioctx, image) as img:
+                    # Like 'rbd resize' without --allow-shrink
+                    if size < img.size():
+                        raise RBDException('Shrinking %s is not allowed'
+                                           % full_name)
+                    img.resize(size)
+            return
+
+        RBD.run(cephx, ['resize', full_name, '--size', str(size)], log=log)
 
     @staticmethod
-    def remove(image, pool=None, cephx=None):
+    def remove(image, pool=None, cephx=None, log=None):
         """ Remove an RBD image """
-        image = RBD.format_name(image, pool=pool)
-        return RBD.exc(cephx, 'rm', image)
+        full_name = RBD.format_name(image, pool=pool)
+        if have_bindings():
+            with librbd_op('remove', full_name):
+                rbd.RBD().remove(get_ioctx(pool, cephx=cephx), image)
+            return
 
+        RBD.run(cephx, ['rm', full_name], log=log)
 
-def read_env():
+
+def read_env(environ=None, stderr=None):
     """Read the enviromental variables"""
-    name = os.getenv("VOL_CNAME")
+    if environ is None:
+        environ = os.environ
+    name = environ.get("VOL_CNAME")
     if name is None:
-        sys.stderr.write('The environment variable VOL_CNAME is missing.\n')
+        stderr = stderr or sys.stderr
+        stderr.write('The environment variable VOL_CNAME is missing.\n')
         return None
 
+    # Sort the EXTP_* variables into userspace URI parameters and the rest,
+    # in a single pass over the environment
     extp_params = {}
-    for k, v in os.environ.iteritems():
+    userspace_params = {}
+    for k, v in environ.items():
         if k.startswith(PREFIX_EXTP):
-            extp_params[k[len(PREFIX_EXTP):].lower()] = v
-
-    reuse_data = False
-    if extp_params.get("reuse_data"):
-        reuse_data = re.match(TRUE_PATTERN, os.getenv("EXTP_REUSE_DATA"),
-                              flags=re.IGNORECASE) is not None
-        extp_params.pop("reuse_data")
-
-    userspace_only = False
-    if extp_params.get("userspace_only"):
-        userspace_only = re.match(
-            TRUE_PATTERN, os.getenv("EXTP_USERSPACE_ONLY"),
-            flags=re.IGNORECASE) is not None
-        extp_params.pop("userspace_only")
-
-    cephx_keys = ['cephx_id', 'cephx_keyring', 'cephx_keyfile']
+            k = k[len(PREFIX_EXTP):].lower()
+            if k.startswith(PREFIX_USP):
+                userspace_params[k[len(PREFIX_USP):]] = v
+            else:
+                extp_params[k] = v
+
+    reuse_data = \
+        extp_params.pop("reuse_data", "").strip().lower() in TRUE_VALUES
+    userspace_only = \
+        extp_params.pop("userspace_only", "").strip().lower() in TRUE_VALUES
+    debug = extp_params.pop("debug", "").strip().lower() in TRUE_VALUES
+
     cephx = {}
-    for k in cephx_keys:
-        param = extp_params.get(k)
+    for k in CEPHX_KEYS:
+        param = extp_params.pop('cephx_' + k, None)
         if param:
-            cephx[k[len('cephx_'):]] = param
-            extp_params.pop(k)
+            cephx[k] = param
 
-    userspace_params = {}
-    for p, v in extp_params.iteritems():
-        if p.startswith(PREFIX_USP):
-            userspace_params[p[len(PREFIX_USP):]] = v
-            extp_params.pop(p)
-
-    env = {"name": os.getenv("VOL_CNAME"),
-           "size": os.getenv("VOL_SIZE"),
-           "snapshot_name": os.getenv("VOL_SNAPSHOT_NAME"),
+    env = {"name": name,
+           "size": environ.get("VOL_SIZE"),
+           "snapshot_name": environ.get("VOL_SNAPSHOT_NAME"),
            "cephx": cephx,
            "reuse_data": reuse_data,
            "userspace_only": userspace_only,
-           "userspace_params": userspace_params
+           "userspace_params": userspace_params,
+           "debug": debug
            }
     env.update(extp_params)
     return env
@@ -260,21 +545,22 @@ def create(env):
     stripe_unit = env.get("stripe_unit")
     stripe_count = env.get("stripe_count")
     cephx = env.get("cephx")
+    full_name = RBD.format_name(name, pool=pool)
 
     if reuse_data:
-        sys.stderr.write("Reusing previous data for %s\n"
-                         % RBD.format_name(name, pool=pool))
+        env["stderr"].write("Reusing previous data for %s\n" % full_name)
         return 0
 
     if origin:
-        sys.stderr.write("Cloning is not supported yet\n")
+        env["stderr"].write("Cloning is not supported yet\n")
         return 1
     else:
-        sys.stderr.write("Creating volume '%s' of size '%s'\n"
-                         % (RBD.format_name(name, pool=pool), size))
+        env["stderr"].write("Creating volume '%s' of size '%s'\n"
+                            % (full_name, size))
         RBD.create(name, size, pool=pool, image_format=image_format,
                    image_feature=image_feature, stripe_unit=stripe_unit,
-                   stripe_count=stripe_count, cephx=cephx)
+                   stripe_count=stripe_count, cephx=cephx,
+                   log=env["stderr"])
     return 0
 
 
@@ -282,11 +568,11 @@ def snapshot(env):
     """Create a snapshot of an existing RBD Image."""
     # name = env.get("name")
     # snapshot_name = env.get("snapshot_name")
-    # sys.stderr.write("Creating snapshot '%s' from '%s'\n" %
-    #                  (snapshot_name, name))
+    # env["stderr"].write("Creating snapshot '%s' from '%s'\n" %
+    #                     (snapshot_name, name))
     # RBD.snapshot(name, snapshot_name)
     # return 0
-    sys.stderr.write("RBD snapshot is not supported yet")
+    env["stderr"].write("RBD snapshot is not supported yet")
     return 1
 
 
@@ -312,7 +598,7 @@ def format_qemu_uri(name, pool=None, cephx=None, conf_file=None, cache=None,
         # although if 'ceph.conf' does not says otherwise, 'rbd_cache' is set
         # to true.
         extra_conf += ':rbd_cache_max_dirty=0'
-    for k, v in kwargs.iteritems():
+    for k, v in kwargs.items():
         extra_conf += ':%s=%s' % (k, v)
 
     if extra_conf:
@@ -340,20 +626,20 @@ def attach(env):
     if userspace_only:
         device = ""
     else:
-        device = RBD.get_device(name)
-        cephx = env.get("cephx")
+        full_name = RBD.format_name(name, pool=pool)
+        device = RBD.get_device(name, pool=pool)
         if device is None:
-            device = RBD.map(name, pool=pool, cephx=cephx)
-            sys.stderr.write("Mapped image '%s' to '%s' \n"
-                             % (RBD.format_name(name, pool=pool), device))
+            device = RBD.map(name, pool=pool, cephx=cephx,
+                             log=env["stderr"])
+            env["stderr"].write("Mapped image '%s' to '%s' \n"
+                                % (full_name, device))
         else:
-            sys.stderr.write("Image '%s' already mapped to device '%s' \n"
-                             % (RBD.format_name(name, pool=pool), device))
+            env["stderr"].write("Image '%s' already mapped to device '%s' \n"
+                                % (full_name, device))
 
-    sys.stdout.write("%s" % device)
     qemu_uri = format_qemu_uri(name, pool=pool, cephx=cephx, cache=cache,
                                **userspace_params)
-    sys.stdout.write("\n%s" % qemu_uri)
+    env["stdout"].write("%s\n%s" % (device, qemu_uri))
 
     return 0
 
@@ -373,9 +659,9 @@ def detach(env):
         cephx = env.get("cephx")
         device = RBD.get_device(name, pool=pool)
         if device:
-            RBD.unmap(device, cephx=cephx)
+            RBD.unmap(device, cephx=cephx, log=env["stderr"])
 
-        sys.stderr.write("Unmapped %s\n" % RBD.format_name(name, pool=pool))
+        env["stderr"].write("Unmapped %s\n" % RBD.format_name(name, pool=pool))
 
     return 0
 
@@ -387,9 +673,9 @@ def grow(env):
     pool = env.get("rbd_pool")
     cephx = env.get("cephx")
 
-    sys.stderr.write("Resizing '%s'. New size '%s'\n"
-                     % (RBD.format_name(name, pool=pool), size))
-    RBD.resize(name, size, pool=pool, cephx=cephx)
+    env["stderr"].write("Resizing '%s'. New size '%s'\n"
+                        % (RBD.format_name(name, pool=pool), size))
+    RBD.resize(name, size, pool=pool, cephx=cephx, log=env["stderr"])
     return 0
 
 
@@ -403,8 +689,8 @@ def remove(env):
     name = env.get("name")
     pool = env.get("rbd_pool")
     cephx = env.get("cephx")
-    sys.stderr.write("Deleting '%s'\n" % RBD.format_name(name, pool=pool))
-    RBD.remove(name, pool=pool, cephx=cephx)
+    env["stderr"].write("Deleting '%s'\n" % RBD.format_name(name, pool=pool))
+    RBD.remove(name, pool=pool, cephx=cephx, log=env["stderr"])
     return 0
 
 
@@ -416,42 +702,95 @@ def setinfo(env):
     return 0
 
 
-def main():
-    env = read_env()
+ACTIONS = {
+    'create': create,
+    'snapshot': snapshot,
+    'attach': attach,
+    'detach': detach,
+    'grow': grow,
+    'remove': remove,
+    'verify': verify,
+    'setinfo': setinfo,
+}
+
+
+def run_action(action_name, environ=None, stdout=None, stderr=None):
+    """
+    Run an action in this process and return its exit code
+
+    The action writes its output to stdout and stderr, which default to the
+    ones of the process. The daemon passes its own for each request.
+
+    """
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    env = read_env(environ, stderr=stderr)
     if env is None:
-        sys.stderr.write("Wrong environment. Aborting...\n")
+        stderr.write("Wrong environment. Aborting...\n")
         return 1
+    env["stdout"] = stdout
+    env["stderr"] = stderr
 
-    actions = {
-        'create': create,
-        'snapshot': snapshot,
-        'attach': attach,
-        'detach': detach,
-        'grow': grow,
-        'remove': remove,
-        'verify': verify,
-        'setinfo': setinfo,
-    }
-
-    try:
-        action_name = os.path.basename(sys.argv[0])
-        action = actions[action_name]
-    except KeyError:
-        sys.stderr.write("Action '%s' not supported\n" % action_name)
+    action = ACTIONS.get(action_name)
+    if action is None:
+        stderr.write("Action '%s' not supported\n" % action_name)
         return 1
 
     try:
         return action(env)
     except RBDException as e:
-        sys.stderr.write("RBD command error: %s\n" % e)
+        stderr.write("RBD command error: %s\n" % e)
         return 1
     except Exception as e:
         # Log all exceptions here and return error
-        import traceback
-        trace = traceback.format_exc()
-        sys.stderr.write("Error: %s\n" % e)
-        sys.stderr.write("Trace: %s\n" % trace)
+        stderr.write("Error: %s\n" % e)
+        if env.get("debug"):
+            stderr.write("Trace: %s\n" % traceback.format_exc())
+        return 1
+
+
+def call_daemon(action_name, environ):
+    """
+    Run an action in ext_rbd_daemon.py, if it is running
+
+    Returns the exit code, stdout and stderr of the action, or None if the
+    daemon cannot be reached within DAEMON_TIMEOUT.
+
+    """
+    request = {"action": action_name,
+               "env": {k: v for k, v in environ.items()
+                       if k.startswith(("VOL_", PREFIX_EXTP))}}
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(DAEMON_TIMEOUT)
+    try:
+        try:
+            sock.connect(DAEMON_SOCKET)
+        except OSError:
+            return None
+        # The action may take long, e.g. removing a large image
+        sock.settimeout(None)
+        sock.sendall(json.dumps(request).encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile('rb') as f:
+            reply = json.loads(f.read().decode('utf-8'))
+    finally:
+        sock.close()
+    return reply["rc"], reply["stdout"], reply["stderr"]
+
+
+def main():
+    try:
+        reply = call_daemon(_ACTION, os.environ)
+    except (OSError, ValueError) as e:
+        sys.stderr.write("Daemon error: %s\n" % e)
         return 1
+    if reply is None:
+        return run_action(_ACTION)
+
+    rc, stdout, stderr = reply
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    return rc
 
 
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2016-2017 GRNET S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+"""
+Daemon mode for the RBD storage provider of the ganeti extstorage template
+
+The daemon listens on a unix socket (ext_rbd.DAEMON_SOCKET) and runs the
+actions of ext_rbd.py on behalf of its scripts. This way the Python start-up,
+the import of the Ceph bindings and the connection to the cluster are paid
+once, instead of on every action Ganeti runs.
+
+When the socket is present, the attach, create, etc. scripts send the action
+name and their VOL_* and EXTP_* environment variables to the daemon, and
+print the exit code, stdout and stderr it replies with. When it is not, they
+run the action themselves.
+
+Each request is a JSON object {"action": ..., "env": {...}}, sent by the
+client before it shuts down its write side. The reply is a JSON object
+{"rc": ..., "stdout": ..., "stderr": ...}. Each request is served in its own
+thread, with its own output streams, so a slow action (e.g. removing a large
+image) does not hold up the others. A client that cannot connect within
+ext_rbd.DAEMON_TIMEOUT runs the action itself.
+
+"""
+
+import io
+import os
+import sys
+import json
+import socket
+import signal
+import socketserver
+
+import ext_rbd
+
+
+class ActionHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        data = self.rfile.read()
+        if not data:
+            # A daemon starting up, checking whether we are running
+            return
+        request = json.loads(data.decode('utf-8'))
+        stdout, stderr = io.StringIO(), io.StringIO()
+
+        # Images may have been (un)mapped since the previous request
+        ext_rbd.RBD.invalidate_mappings()
+        rc = ext_rbd.run_action(request["action"], request["env"],
+                                stdout=stdout, stderr=stderr)
+
+        reply = {"rc": rc,
+                 "stdout": stdout.getvalue(),
+                 "stderr": stderr.getvalue()}
+        try:
+            self.wfile.write(json.dumps(reply).encode('utf-8'))
+        except BrokenPipeError:
+            # The client went away, e.g. killed by Ganeti
+            pass
+
+
+def is_listening(path):
+    """Return whether a daemon is accepting connections on the socket"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def main():
+    path = ext_rbd.DAEMON_SOCKET
+    if is_listening(path):
+        sys.stderr.write("Another daemon is listening on %s\n" % path)
+        return 1
+    if os.path.exists(path):
+        # Left behind by a daemon that did not exit cleanly
+        os.unlink(path)
+
+    # Only root may talk to the daemon
+    umask = os.umask(0o077)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, ActionHandler)
+    finally:
+        os.umask(umask)
+
+    # Exit through the finally clause below, to remove the socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # New requests are run by the scripts themselves from now on. The
+        # ones in progress are finished before exiting, since the atexit
+        # hook of ext_rbd closes the cluster handles they use.
+        os.unlink(path)
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())